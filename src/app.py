@@ -1,19 +1,53 @@
 import cv2
+import os
+import struct
+import sys
 import threading
 import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, Response, render_template, request, jsonify
+from cvutil import encode_jpeg, limit_opencv_threads
 
 app = Flask(__name__, template_folder='.')
 
 # ─── CONFIG ──────────────────────────────────────────────────────────────────
-# Load pre-trained face detector
-face_cascade = cv2.CascadeClassifier(
-    cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-)
+limit_opencv_threads()
+MAX_WIDTH = 800
+
+# Int8 YuNet face detector (OpenCV DNN, CPU backend). Download from the
+# opencv_zoo repo and place it next to this file.
+YUNET_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'face_detection_yunet_2023mar_int8.onnx')
+# Classical fallback, from opencv/data/lbpcascades
+LBP_CASCADE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'lbpcascade_frontalface_improved.xml')
+
+def create_face_detector():
+    return cv2.FaceDetectorYN.create(
+        YUNET_MODEL, "", (MAX_WIDTH, 0), score_threshold=0.6
+    )
+
+# Load pre-trained face detector, falling back to LBP, then Haar cascades
+face_detector = None
+face_cascade = None
+try:
+    face_detector = create_face_detector()
+except (cv2.error, AttributeError):
+    # LBP features are integer compares, much cheaper than Haar's sums. The
+    # opencv-python wheels only ship Haar cascades, so LBP is read from here.
+    print(f"[Warning] '{YUNET_MODEL}' not loadable, falling back to LBP cascade")
+    face_cascade = cv2.CascadeClassifier(LBP_CASCADE)
+    if face_cascade.empty():
+        print(f"[Warning] '{LBP_CASCADE}' not found, falling back to Haar cascade")
+        face_cascade = cv2.CascadeClassifier(
+            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        )
 
 # ─── GLOBAL STATE ────────────────────────────────────────────────────────────
 lock = threading.Lock()
+frame_ready = threading.Condition(lock) # Notified whenever outputFrame changes
+count_changed = threading.Condition(lock) # Notified only when current_count changes
 outputFrame = None
 current_count = 0
 
@@ -21,7 +55,96 @@ current_count = 0
 input_mode = 'webcam' 
 uploaded_image_processed = None # Stores the processed static image
 
+# Per-thread scratch buffers, one per name. The webcam thread and upload
+# requests may run process_frame at the same time, so no sharing. A buffer
+# is replaced when the shape changes, so each thread holds at most one per
+# name however many upload resolutions it sees.
+_scratch = threading.local()
+
+def scratch_buffer(name, shape):
+    bufs = getattr(_scratch, 'bufs', None)
+    if bufs is None:
+        bufs = _scratch.bufs = {}
+    buf = bufs.get(name)
+    if buf is None or buf.shape != shape:
+        buf = bufs[name] = np.empty(shape, np.uint8)
+    return buf
+
 # ─── IMAGE PROCESSING ENGINE ─────────────────────────────────────────────────
+BOX_COLOR = (0, 255, 255)
+BOX_THICKNESS = 2
+
+def render_label(text):
+    """
+    Rasterizes a label once. Returns the BGR bitmap and a mask of its text pixels.
+    """
+    (tw, th), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)
+    img = np.zeros((th + baseline + 2, tw + 2, 3), np.uint8)
+    cv2.putText(img, text, (1, th + 1), cv2.FONT_HERSHEY_SIMPLEX, 0.5, BOX_COLOR, 2)
+    return img, img.any(axis=2, keepdims=True)
+
+_label_img, _label_mask = render_label("DETECTED")
+
+def draw_face_box(frame, x, y, w, h):
+    """
+    Draws a box and the pre-rendered label with slice writes, no per-face
+    font rasterization. Everything is clipped to the frame.
+    """
+    fh, fw = frame.shape[:2]
+    t = BOX_THICKNESS
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, fw), min(y + h, fh)
+    if x0 < x1 and y0 < y1:
+        frame[y0:y0+t, x0:x1] = BOX_COLOR
+        frame[max(y1-t, y0):y1, x0:x1] = BOX_COLOR
+        frame[y0:y1, x0:x0+t] = BOX_COLOR
+        frame[y0:y1, max(x1-t, x0):x1] = BOX_COLOR
+
+    # Label sits just above the box
+    lh, lw = _label_img.shape[:2]
+    ly, lx = y - lh - 2, x
+    ly0, lx0 = max(ly, 0), max(lx, 0)
+    ly1, lx1 = min(ly + lh, fh), min(lx + lw, fw)
+    if ly0 < ly1 and lx0 < lx1:
+        src = (slice(ly0 - ly, ly1 - ly), slice(lx0 - lx, lx1 - lx))
+        np.copyto(frame[ly0:ly1, lx0:lx1], _label_img[src], where=_label_mask[src])
+
+# A dnn net is not thread-safe and the input size is detector state, so the
+# webcam worker and each upload thread get their own YuNet instance
+_detectors = threading.local()
+
+def thread_face_detector():
+    detector = getattr(_detectors, 'face_detector', None)
+    if detector is None:
+        detector = _detectors.face_detector = create_face_detector()
+    return detector
+
+def detect_faces(frame):
+    """
+    Returns an (N, 4) int array of (x, y, w, h) face boxes for a BGR frame.
+    """
+    if face_detector is not None:
+        detector = thread_face_detector()
+        height, width = frame.shape[:2]
+        detector.setInputSize((width, height))
+        _, faces = detector.detect(frame)
+        if faces is None:
+            return np.empty((0, 4), dtype=int)
+        return faces[:, :4].astype(int)
+
+    # Cascade fallback needs grayscale; convert into a reused buffer
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY,
+                        dst=scratch_buffer('gray', frame.shape[:2]))
+
+    # Cascade cost scales with pixel count: detect at half resolution with a
+    # coarser pyramid, then scale the boxes back up
+    height, width = gray.shape
+    hw, hh = width // 2, height // 2
+    small = cv2.resize(gray, (hw, hh), dst=scratch_buffer('gray_half', (hh, hw)),
+                       interpolation=cv2.INTER_AREA)
+    faces = face_cascade.detectMultiScale(small, 1.2, 4, minSize=(24, 24))
+    return np.asarray(faces, dtype=int).reshape(-1, 4) * 2
+
 def process_frame(frame):
     """
     Takes a raw frame (numpy array), detects faces, draws boxes,
@@ -29,22 +152,19 @@ def process_frame(frame):
     """
     # Resize for consistency and performance
     height, width = frame.shape[:2]
-    max_width = 800
-    if width > max_width:
-        scale = max_width / width
-        frame = cv2.resize(frame, (int(width * scale), int(height * scale)))
+    if width > MAX_WIDTH:
+        scale = MAX_WIDTH / width
+        tw, th = int(width * scale), int(height * scale)
+        frame = cv2.resize(frame, (tw, th), dst=scratch_buffer('resize', (th, tw, 3)),
+                           interpolation=cv2.INTER_LINEAR_EXACT)
 
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    
-    # Detect faces
-    faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+    # Detect faces (YuNet takes BGR directly, no grayscale pass)
+    faces = detect_faces(frame)
     count = len(faces)
 
     # Draw UI
-    for (x, y, w, h) in faces:
-        cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 255), 2)
-        cv2.putText(frame, "DETECTED", (x, y-10), 
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,255), 2)
+    for (x, y, w, h) in faces.tolist():
+        draw_face_box(frame, x, y, w, h)
         
     # Overlay "Source" indicator
     label = "LIVE FEED" if input_mode == 'webcam' else "STATIC IMAGE ANALYSIS"
@@ -52,17 +172,91 @@ def process_frame(frame):
     cv2.putText(frame, label, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
 
     # Encode to JPEG
-    (flag, encodedImage) = cv2.imencode(".jpg", frame)
-    if not flag:
+    jpeg_bytes = encode_jpeg(frame)
+    if jpeg_bytes is None:
         return None, 0
         
-    return encodedImage.tobytes(), count
+    return jpeg_bytes, count
+
+# ─── UPLOAD DECODING ─────────────────────────────────────────────────────────
+# libjpeg-turbo can decode straight to 1/2, 1/4 or 1/8 scale
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                        (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2))
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def jpeg_dimensions(data):
+    """
+    Returns (width, height) from a JPEG's SOF header, or None if not a JPEG.
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF: # Fill byte
+            i += 1
+        elif marker in SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7: # No-length markers
+            i += 2
+        else:
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+def upload_decode_flag(data):
+    """
+    Picks the smallest decode scale that still leaves the image at least
+    MAX_WIDTH wide, so process_frame only has a small resize left to do.
+    """
+    dims = jpeg_dimensions(data)
+    if dims is not None:
+        for factor, flag in REDUCED_DECODE_FLAGS:
+            if dims[0] // factor >= MAX_WIDTH:
+                return flag
+    return cv2.IMREAD_COLOR
 
 # ─── WEBCAM THREAD ───────────────────────────────────────────────────────────
-def capture_feed():
+def open_camera(index=0):
+    """
+    Opens the webcam asking for MJPEG over V4L2 so frames are decoded by
+    libjpeg-turbo instead of converted from YUYV. Falls back to the default backend.
+    """
+    if sys.platform.startswith('linux'):
+        cap = cv2.VideoCapture(index, cv2.CAP_V4L2)
+        if cap.isOpened():
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1) # Always read the newest frame
+            return cap
+        cap.release()
+    return cv2.VideoCapture(index)
+
+# Single worker, so frames are processed in order while the next one is read
+process_pool = ThreadPoolExecutor(max_workers=1)
+
+def publish_webcam_frame(frame):
     global outputFrame, current_count
-    cap = cv2.VideoCapture(0)
+    jpeg_bytes, count = process_frame(frame)
+
+    with frame_ready:
+        # An upload may have switched modes while this frame was in flight
+        if input_mode != 'webcam':
+            return
+        outputFrame = jpeg_bytes
+        frame_ready.notify_all()
+        if count != current_count:
+            current_count = count
+            count_changed.notify_all()
+
+def capture_feed():
+    cap = open_camera(0)
     time.sleep(2.0) # Warmup
+    pending = None
 
     while True:
         # If we are in 'image' mode, we pause the webcam logic to save resources
@@ -74,13 +268,15 @@ def capture_feed():
         if not ret:
             continue
 
-        jpeg_bytes, count = process_frame(frame)
-
-        with lock:
-            outputFrame = jpeg_bytes
-            current_count = count
-        
-        time.sleep(0.03)
+        # Detection + encode run on the pool (cv2 releases the GIL) while this
+        # thread reads the next frame. Wait for the previous frame first so at
+        # most one is in flight.
+        if pending is not None:
+            try:
+                pending.result()
+            except Exception as e:
+                print(f"[Warning] Frame processing failed: {e}")
+        pending = process_pool.submit(publish_webcam_frame, frame)
 
 # ─── FLASK ROUTES ────────────────────────────────────────────────────────────
 @app.route('/')
@@ -106,8 +302,9 @@ def upload_image():
         return jsonify({"error": "No file"}), 400
 
     # Convert uploaded file to numpy array for OpenCV
-    npimg = np.frombuffer(file.read(), np.uint8)
-    frame = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+    data = file.read()
+    npimg = np.frombuffer(data, np.uint8)
+    frame = cv2.imdecode(npimg, upload_decode_flag(data))
 
     if frame is None:
         return jsonify({"error": "Invalid image"}), 400
@@ -115,52 +312,58 @@ def upload_image():
     # Process immediately
     jpeg_bytes, count = process_frame(frame)
 
-    with lock:
+    with frame_ready:
         input_mode = 'image'
         outputFrame = jpeg_bytes
-        current_count = count
         uploaded_image_processed = jpeg_bytes # Cache it
+        frame_ready.notify_all()
+        if count != current_count:
+            current_count = count
+            count_changed.notify_all()
 
     return jsonify({"status": "switched_to_image", "count": count})
 
 # NEW: Reset back to webcam
 @app.route('/reset', methods=['POST'])
 def reset_feed():
-    global input_mode
+    global input_mode, uploaded_image_processed
     with lock:
         input_mode = 'webcam'
+        uploaded_image_processed = None # Don't keep the static image pinned
     return jsonify({"status": "switched_to_webcam"})
 
 # ─── GENERATORS ──────────────────────────────────────────────────────────────
 def generate_mjpeg():
-    global outputFrame
+    last_sent = None
     while True:
-        with lock:
-            if outputFrame is None:
-                continue
+        # Wake as soon as a new frame is published. A static image never
+        # changes, so it is only re-sent on the 1s timeout to save bandwidth.
+        with frame_ready:
+            frame_ready.wait_for(lambda: outputFrame is not last_sent, timeout=1.0)
             data = outputFrame
+
+        if data is None:
+            continue
+        last_sent = data
         
         # Standard MJPEG yield
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + data + b'\r\n')
-        
-        # If static image, we slow down the refresh rate significantly
-        # to save bandwidth, since the image isn't changing.
-        delay = 0.05 if input_mode == 'webcam' else 1.0
-        time.sleep(delay)
 
 def generate_sse():
-    global current_count
-    last_sent = -1
+    last_sent = None
     while True:
-        with lock:
+        # Wake immediately on change; the timeout doubles as a heartbeat
+        with count_changed:
+            count_changed.wait_for(lambda: current_count != last_sent, timeout=15)
             cnt = current_count
         
-        # Always send heartbeat every second, or immediately on change
+        last_sent = cnt
         yield f"data: {cnt}\n\n"
-        time.sleep(0.5)
+
+# Started at import so it also runs under gunicorn (see gunicorn.conf.py)
+t = threading.Thread(target=capture_feed, daemon=True)
+t.start()
 
 if __name__ == '__main__':
-    t = threading.Thread(target=capture_feed, daemon=True)
-    t.start()
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""
+OpenCV setup and JPEG encoding shared by app.py, inf.py and server.py.
+"""
+import cv2
+import os
+
+def limit_opencv_threads():
+    """
+    Capture, AI and request threads already run in parallel; cap OpenCV's
+    own parallel_for pool so they don't oversubscribe the CPU.
+    """
+    cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+
+JPEG_QUALITY = 75
+
+# PyTurboJPEG encodes straight to bytes (no cv::Mat + .tobytes() copy) with
+# 4:2:0 chroma subsampling. Optional; falls back to cv2.imencode.
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    TJPF_BGR = None
+    turbo_jpeg = None
+
+# Baseline Huffman tables, no progressive scans: cheapest cv2 encode.
+# Speed also depends on OpenCV being linked against libjpeg-turbo (SIMD).
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY,
+               cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+               cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+if turbo_jpeg is None and 'libjpeg-turbo' not in cv2.getBuildInformation():
+    print("[Warning] OpenCV is not built with libjpeg-turbo, JPEG encoding will be slow")
+
+def encode_jpeg(frame):
+    """
+    Encodes a BGR frame. Returns the JPEG bytes, or None on failure.
+    """
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(frame, quality=JPEG_QUALITY, pixel_format=TJPF_BGR,
+                                 jpeg_subsample=TJSAMP_420)
+    ok, buf = cv2.imencode('.jpg', frame, JPEG_PARAMS)
+    return buf.tobytes() if ok else None
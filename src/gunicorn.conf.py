@@ -0,0 +1,30 @@
+# Gunicorn settings for serving the MJPEG / SSE streams, picked up
+# automatically when run from this directory:
+#
+#   gunicorn server:app      (or app:app, inf:app)
+#
+# One worker only: the camera, the model and the shared frame state live in
+# the process. Every viewer holds a long-lived connection, so it gets its
+# own thread rather than tying up Werkzeug's dev server.
+#
+# The thread pool is fixed and each open stream holds a thread until the
+# client disconnects. A browser tab keeps two (/video_feed and
+# /count_feed), so `threads` caps viewers at about threads / 2 tabs; past
+# that, every request, / and /upload included, waits for a free thread.
+#
+# Don't add workers or preload_app to share the weights between them:
+# /start_stream, /video_feed and /count_feed would land on processes with
+# different streams, threads started at import don't survive fork(), and
+# CUDA can't be used in a child forked after it was initialised. Inference
+# is batched on the GPU and each frame is encoded once for all viewers, so
+# to serve more viewers raise `threads` instead.
+bind = "0.0.0.0:5000"
+workers = 1
+# No heartbeat timeout: the worker imports the app before its first
+# heartbeat, and that import can spend minutes exporting a TensorRT engine.
+# A timeout would kill it mid-export on every boot.
+timeout = 0
+worker_class = "gthread"
+# Streaming threads mostly sleep on a queue or condition; 256 threads is
+# room for ~120 tabs plus ordinary requests
+threads = 256
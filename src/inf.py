@@ -4,7 +4,10 @@ import time
 import threading
 import queue
 import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, Response, render_template_string
+from cvutil import encode_jpeg, limit_opencv_threads
 from ultralytics import YOLO
 from dotenv import load_dotenv
 
@@ -14,23 +17,112 @@ load_dotenv()  # This loads the variables from .env
 app = Flask(__name__)
 
 # --- Configuration ---
+limit_opencv_threads()
 # Now fetching from the .env file
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
 AWS_REGION = os.getenv("AWS_REGION")
 STREAM_NAME = os.getenv("STREAM_NAME")
 
+# AI input size (width, height). The TensorRT engine is exported at this size.
+AI_WIDTH = 640
+AI_HEIGHT = 360
+# Ultralytics letterboxes 360 up to the next stride-32 multiple. Tensor input
+# skips its preprocessing, so it has to arrive already padded.
+TENSOR_HEIGHT = 384
+MODEL_WEIGHTS = "best.pt"
+MODEL_ENGINE = "best.engine"
+MODEL_INT8_ENGINE = "best_int8.engine"
+# Ultralytics dataset yaml listing ~500 representative stream frames. When
+# present, an INT8 engine is calibrated on it and preferred over FP16.
+CALIB_DATA = "calib.yaml"
+# Skip inference while the mean abs difference of a 32x32 gray thumbnail,
+# against the last inferred frame, stays below this (0-255 scale)
+MOTION_GATE_SIZE = 32
+MOTION_THRESHOLD = 2.0
+
 # --- Shared State ---
 class VideoState:
     def __init__(self):
-        self.frame = None
-        self.count = 0
+        # (frame, jpeg_bytes, count, frame_id), replaced as a whole so readers
+        # can take it without the lock (reference assignment is atomic).
+        # jpeg_bytes is the frame encoded once, shared by all viewers.
+        self.snapshot = (None, None, 0, 0)
+        # Only writers of snapshot take the lock
         self.lock = threading.Lock()
+        # Notified by the capture thread each time frame_id advances
+        self.frame_event = threading.Condition(self.lock)
+        # Notified by the AI thread only when the count changes
+        self.count_changed = threading.Condition(self.lock)
         self.running = True
 
 state = VideoState()
 
+# --- Thread Placement ---
+CAPTURE_CORE = 0
+AI_CORE = 1
+
+# Process affinity at import, before any thread is pinned
+try:
+    ALL_CORES = sorted(os.sched_getaffinity(0))
+except AttributeError:
+    ALL_CORES = []
+
+def pin_current_thread(core, niceness=0):
+    """
+    Best-effort: pins the calling thread to one core so consecutive frames stay
+    in that core's L1/L2, leaving the other cores to Flask. Threads started
+    from here afterwards inherit the pin. Linux only; needs 4+ cores.
+    """
+    try:
+        if len(ALL_CORES) >= 4:
+            os.sched_setaffinity(0, {ALL_CORES[core]})
+        if niceness:
+            # Absolute, so re-pinning doesn't stack. Calling thread only on Linux.
+            os.setpriority(os.PRIO_PROCESS, 0, niceness)
+    except (AttributeError, OSError):
+        pass
+
+def unpin_current_thread():
+    """Undoes pin_current_thread for the calling thread."""
+    try:
+        if ALL_CORES:
+            os.sched_setaffinity(0, ALL_CORES)
+        os.setpriority(os.PRIO_PROCESS, 0, 0)
+    except (AttributeError, OSError):
+        pass
+
 # --- Thread 1: The "Buffer Filler" (Reads KVS) ---
+# Single worker: the encode of one frame overlaps the read of the next
+encode_pool = ThreadPoolExecutor(max_workers=1)
+# Spawn the worker now, from the main thread, so it doesn't inherit the
+# capture thread's core pin
+encode_pool.submit(lambda: None)
+
+def publish_frame(frame):
+    # Encode once here instead of once per connected viewer
+    new_jpeg = encode_jpeg(frame)
+
+    # Update the shared buffer immediately and wake the consumers
+    with state.frame_event:
+        _, jpeg, count, frame_id = state.snapshot
+        frame_id += 1
+        state.snapshot = (frame, new_jpeg or jpeg, count, frame_id)
+        state.frame_event.notify_all()
+
+def open_stream(url):
+    """
+    Opens the stream unpinned, so FFmpeg's decoder threads spread over all
+    cores at normal priority, then pins the calling thread, which only reads.
+    Frame reads must not be starved by request handling.
+    """
+    unpin_current_thread()
+    cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+    # ⚠️ CRITICAL: Limit internal buffer to 1 frame to prevent "ghost" lag
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    pin_current_thread(CAPTURE_CORE, niceness=-5)
+    return cap
+
 def capture_thread():
     print("[Thread 1] Connecting to AWS KVS...")
     
@@ -60,53 +152,143 @@ def capture_thread():
         )['HLSStreamingSessionURL']
 
         # Open the stream
-        cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
-        
-        # ⚠️ CRITICAL: Limit internal buffer to 1 frame to prevent "ghost" lag
-        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        cap = open_stream(url)
 
+        pending = None
         while state.running:
             ret, frame = cap.read()
             if not ret:
                 print("Stream interrupted. Reconnecting...")
                 time.sleep(2)
-                cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+                cap = open_stream(url)
                 continue
             
-            # Update the shared buffer immediately
-            with state.lock:
-                state.frame = frame
+            # Hand the encode + publish to the pool and go straight back to
+            # reading. At most one frame is in flight.
+            if pending is not None:
+                try:
+                    pending.result()
+                except Exception as e:
+                    print(f"[Warning] Frame publish failed: {e}")
+            pending = encode_pool.submit(publish_frame, frame)
             
             # We don't sleep here; we want to read as fast as KVS sends data.
     except Exception as e:
         print(f"Error in capture thread: {e}")
 
 # --- Thread 2: The "AI Worker" (Reads Buffer -> Processes) ---
+def export_engine():
+    """
+    Builds the missing TensorRT engine from the .pt weights, once, if a CUDA
+    device is available: INT8 when calibration data exists, else FP16.
+    """
+    import torch
+    if not torch.cuda.is_available():
+        return
+    # Static batch 1 at the AI input size: the AI thread only runs the newest frame
+    export_args = dict(format="engine", imgsz=(AI_HEIGHT, AI_WIDTH), device=0, workspace=4)
+
+    if os.path.exists(CALIB_DATA) and not os.path.exists(MODEL_INT8_ENGINE):
+        print(f"[Thread 2] Exporting TensorRT INT8 engine to '{MODEL_INT8_ENGINE}'...")
+        # Ultralytics always writes <weights>.engine, so move it aside
+        path = YOLO(MODEL_WEIGHTS).export(int8=True, data=CALIB_DATA, **export_args)
+        os.replace(path, MODEL_INT8_ENGINE)
+    elif not os.path.exists(MODEL_ENGINE) and not os.path.exists(MODEL_INT8_ENGINE):
+        print(f"[Thread 2] Exporting TensorRT FP16 engine to '{MODEL_ENGINE}'...")
+        YOLO(MODEL_WEIGHTS).export(half=True, **export_args)
+
+def load_model():
+    """
+    Returns (model, predict_kwargs). Prefers an INT8, then FP16, TensorRT
+    engine over the PyTorch weights.
+    """
+    try:
+        export_engine()
+    except Exception as e:
+        print(f"[Warning] TensorRT export failed: {e}")
+
+    if os.path.exists(MODEL_INT8_ENGINE):
+        return YOLO(MODEL_INT8_ENGINE, task="detect"), {"device": 0}
+    if os.path.exists(MODEL_ENGINE):
+        return YOLO(MODEL_ENGINE, task="detect"), {"device": 0, "half": True}
+
+    print(f"[Warning] '{MODEL_ENGINE}' not available, falling back to '{MODEL_WEIGHTS}'")
+    return YOLO(MODEL_WEIGHTS), {}
+
+class CudaFrameInput:
+    """
+    Reusable input path for the GPU engine: the frame is resized straight
+    into pinned uint8 memory, copied to the GPU, then flipped to RGB / NCHW /
+    [0, 1] on the GPU inside a static letterboxed FP16 tensor. The model call
+    reads its result before the next frame is staged, so one buffer is safe
+    to reuse.
+    """
+    def __init__(self):
+        import torch
+        self.staging = torch.empty((AI_HEIGHT, AI_WIDTH, 3), dtype=torch.uint8, pin_memory=True)
+        self.frame = self.staging.numpy() # Resize destination
+        self.gpu_input = torch.full((1, 3, TENSOR_HEIGHT, AI_WIDTH), 114 / 255,
+                                    dtype=torch.float16, device="cuda")
+
+    def upload(self):
+        """Uploads the staged frame and returns the model input."""
+        gpu_u8 = self.staging.to("cuda", non_blocking=True)
+        pad = (TENSOR_HEIGHT - AI_HEIGHT) // 2
+        region = self.gpu_input[0, :, pad:pad + AI_HEIGHT]
+        region.copy_(gpu_u8.flip(-1).permute(2, 0, 1))
+        region.div_(255)
+        return self.gpu_input
+
 def ai_thread():
     print("[Thread 2] Loading YOLO...")
     try:
-        model = YOLO("best.pt")
-        
+        model, predict_kwargs = load_model()
+        # On the GPU engine this thread only does pre/post-processing. The CPU
+        # fallback is left unpinned: torch's intra-op pool would inherit one core.
+        if predict_kwargs:
+            pin_current_thread(AI_CORE)
+        # Reused resize destination, avoids a fresh allocation per frame
+        cuda_input = CudaFrameInput() if predict_kwargs else None
+        resized = cuda_input.frame if cuda_input is not None else \
+            np.empty((AI_HEIGHT, AI_WIDTH, 3), np.uint8)
+        last_id = 0
+        prev_gate = None
+
         while state.running:
-            # 1. Grab a snapshot of the current frame
-            with state.lock:
-                if state.frame is None:
-                    continue
-                # Copy effectively creates a new buffer for the AI to work on
-                # while the main thread continues updating the real frame.
-                working_frame = state.frame.copy()
-
-            # 2. Run Inference (This might take 100ms - 500ms)
+            # 1. Take the newest frame. Older ones that arrived while the last
+            # inference ran are skipped: only the latest count is shown.
+            # cap.read() hands out a new array per frame, so no copy is needed.
+            with state.frame_event:
+                state.frame_event.wait_for(lambda: state.snapshot[3] != last_id, timeout=1.0)
+                working_frame, _, _, frame_id = state.snapshot
+
+            if working_frame is None or frame_id == last_id:
+                continue
+            last_id = frame_id
+
+            # 2. Motion gate: a static scene keeps the previous count
+            small = cv2.resize(working_frame, (MOTION_GATE_SIZE, MOTION_GATE_SIZE),
+                               interpolation=cv2.INTER_AREA)
+            gate = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            if prev_gate is not None and cv2.absdiff(gate, prev_gate).mean() < MOTION_THRESHOLD:
+                continue
+            prev_gate = gate
+
+            # 3. Run Inference (This might take 100ms - 500ms)
             # We resize to 640 for speed, detection accuracy usually remains high
-            input_frame = cv2.resize(working_frame, (640, 360))
-            results = model(input_frame, conf=0.5, classes=[0], verbose=False)
-            
-            # 3. Update the count
-            with state.lock:
-                state.count = len(results[0].boxes)
+            cv2.resize(working_frame, (AI_WIDTH, AI_HEIGHT), dst=resized)
+            source = cuda_input.upload() if cuda_input is not None else resized
+            results = model(source, conf=0.5, classes=[0], verbose=False, **predict_kwargs)
+
+            # 4. Update the count
+            new_count = len(results[0].boxes)
+            with state.count_changed:
+                frame, jpeg, count, frame_id = state.snapshot
+                if new_count != count:
+                    state.snapshot = (frame, jpeg, new_count, frame_id)
+                    state.count_changed.notify_all()
             
-            # AI runs at its own max speed. It effectively "skips" frames
-            # that appeared while it was processing this one.
+            # AI runs at its own max speed, always on the latest frame
     except Exception as e:
         print(f"Error in AI thread: {e}")
 
@@ -116,32 +298,36 @@ t2 = threading.Thread(target=ai_thread, daemon=True).start()
 
 # --- Flask: The "Viewer" (Reads Buffer -> Browser) ---
 def generate_mjpeg():
+    last_id = 0
     while True:
-        with state.lock:
-            if state.frame is None:
-                # If no frame yet, yield a placeholder or wait slightly
-                time.sleep(0.1)
-                continue
-            # Encode the LATEST frame available
-            ret, buffer = cv2.imencode('.jpg', state.frame)
+        # The LATEST frame, already encoded by the capture thread
+        _, data, _, frame_id = state.snapshot
+        if frame_id == last_id:
+            # Block until the capture thread publishes a new frame, so the send
+            # rate follows the stream's real FPS instead of a fixed poll.
+            with state.frame_event:
+                state.frame_event.wait_for(lambda: state.snapshot[3] != last_id, timeout=1.0)
+            _, data, _, frame_id = state.snapshot
+        last_id = frame_id
 
-        if ret:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-        
-        # Cap sending rate to ~30 FPS to save bandwidth
-        time.sleep(0.03)
+        if data is None:
+            continue
+
+        yield (b'--frame\r\n'
+               b'Content-Type: image/jpeg\r\n\r\n' + data + b'\r\n')
 
 def generate_sse_count():
     last_count = -1
     while True:
-        with state.lock:
-            c = state.count
+        c = state.snapshot[2]
+        if c == last_count:
+            # Wake immediately on change; the timeout doubles as a heartbeat
+            with state.count_changed:
+                state.count_changed.wait_for(lambda: state.snapshot[2] != last_count, timeout=15)
+            c = state.snapshot[2]
         
-        if c != last_count:
-            yield f"data: {c}\n\n"
-            last_count = c
-        time.sleep(0.5)
+        yield f"data: {c}\n\n"
+        last_count = c
 
 @app.route('/video_feed')
 def video_feed():
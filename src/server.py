@@ -3,49 +3,440 @@ import time
 import threading
 import queue
 import os
+import gzip
+import struct
 import numpy as np
-from flask import Flask, Response, render_template_string, request, jsonify
+from concurrent.futures import Future
+from flask import Flask, Response, request, jsonify
+from cvutil import TJPF_BGR, encode_jpeg, limit_opencv_threads, turbo_jpeg
 from ultralytics import YOLO
 from dotenv import load_dotenv
 
+# Optional: GPU (NVDEC) decode of the RTSP stream
+try:
+    import av
+except ImportError:
+    av = None
+
 load_dotenv()
 
 app = Flask(__name__)
 
 # --- Configuration ---
+limit_opencv_threads()
 RTSP_URL = "rtsp://10.76.11.62"
+# Capture ring size. A published frame stays intact for FRAME_BUFFERS - 1
+# frame periods. Readers check frame_is_intact() after using it and drop
+# the result if the capture thread may have started overwriting it.
+FRAME_BUFFERS = 3
+# AI input size (width, height)
+AI_WIDTH = 640
+AI_HEIGHT = 360
+
+# Annotated feed frame rate
+FEED_FPS = 30
+FRAME_INTERVAL = 1 / FEED_FPS
+
+def exif_orientation(data):
+    """
+    Returns the EXIF Orientation tag of JPEG bytes: 1 (upright) when there
+    is none, None if the EXIF block can't be parsed.
+    """
+    try:
+        i = 2
+        while i + 4 <= len(data) and data[i] == 0xFF:
+            marker = data[i + 1]
+            if marker == 0xDA: # Start of scan: no metadata past here
+                break
+            length = struct.unpack('>H', data[i + 2:i + 4])[0]
+            if marker == 0xE1 and data[i + 4:i + 10] == b'Exif\0\0':
+                tiff = data[i + 10:i + 2 + length]
+                endian = '<' if tiff[:2] == b'II' else '>'
+                ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+                count = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+                for entry in range(ifd + 2, ifd + 2 + 12 * count, 12):
+                    tag, _, _, value = struct.unpack(endian + 'HHIH', tiff[entry:entry + 10])
+                    if tag == 0x0112:
+                        return value
+                return 1
+            i += 2 + length
+    except struct.error:
+        return None
+    return 1
+
+def decode_image(data):
+    """
+    Decodes uploaded image bytes to BGR. Returns None if undecodable.
+    JPEGs go through libjpeg-turbo via ctypes, which drops the GIL for the
+    whole decode, so concurrent uploads decode in parallel. turbojpeg
+    ignores EXIF orientation, so rotated photos (most phone shots) go
+    through cv2.imdecode, which applies it.
+    """
+    if turbo_jpeg is not None and data[:2] == b'\xff\xd8' and exif_orientation(data) == 1:
+        try:
+            return turbo_jpeg.decode(data, pixel_format=TJPF_BGR)
+        except (OSError, ValueError):
+            pass
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+# Live frames and uploads share one GPU; requests arriving within BATCH_WAIT
+# of each other go through a single model call (see inference_loop)
+MAX_BATCH = 8
+BATCH_WAIT = 0.01
+# Detection thresholds, shared by the Ultralytics predictor and the CUDA
+# graph path so both count the same people (Ultralytics' predict defaults)
+DETECT_CONF = 0.5
+DETECT_IOU = 0.7
+MAX_DET = 300
 
 # --- Global Resources ---
 print("[System] Loading YOLO Model globally...")
+weights = "best_m.pt"
 try:
-    model = YOLO("best_m.pt")
+    model = YOLO(weights)
 except:
     print("[Warning] 'best_m.pt' not found, falling back to 'yolov8n.pt'")
-    model = YOLO("yolov8n.pt")
+    weights = "yolov8n.pt"
+    model = YOLO(weights)
+
+# On CUDA run in FP16, preferably as a TensorRT engine. The engine takes a
+# dynamic batch up to MAX_BATCH at up to 640x640, which covers both the
+# 640x360 live frames and letterboxed uploads.
+predict_args = {}
+try:
+    import torch
+    if torch.cuda.is_available():
+        predict_args = {"device": 0, "half": True}
+        engine = os.path.splitext(weights)[0] + ".engine"
+        if not os.path.exists(engine):
+            print(f"[System] Exporting TensorRT FP16 engine to '{engine}'...")
+            model.export(format="engine", half=True, dynamic=True, batch=MAX_BATCH,
+                         imgsz=640, device=0)
+        model = YOLO(engine, task="detect")
+except Exception as e:
+    print(f"[Warning] TensorRT engine unavailable ({e}), using the PyTorch weights")
+
+# Without CUDA, resize and drawing run on OpenCL (e.g. an integrated GPU)
+# through cv2.UMat when the OpenCV build has it
+USE_OPENCL = not predict_args and cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(USE_OPENCL)
+if USE_OPENCL:
+    print(f"[System] Using OpenCL for image ops on '{cv2.ocl.Device.getDefault().name()}'")
+
+# --- Batched Inference ---
+# Mixed image sizes are letterboxed to a common shape by Ultralytics and
+# boxes mapped back per image.
+
+inference_queue = queue.Queue()
+
+# Batches made only of live AI frames skip Ultralytics' chained numpy
+# preprocessing: one Numba pass writes RGB / CHW / [0, 1] into a reused
+# tensor. Tensor input must be a stride-32 multiple, so 360 rows are padded
+# to 384 at the bottom, which leaves box coordinates unchanged. Optional.
+TENSOR_HEIGHT = 384
 
-model_lock = threading.Lock()
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    import torch
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def preprocess_into(src, dst):
+        for y in prange(src.shape[0]):
+            for x in range(src.shape[1]):
+                dst[0, y, x] = src[y, x, 2] / 255.0
+                dst[1, y, x] = src[y, x, 1] / 255.0
+                dst[2, y, x] = src[y, x, 0] / 255.0
+
+    tensor_buf = np.full((MAX_BATCH, 3, TENSOR_HEIGHT, AI_WIDTH), 114 / 255, np.float32)
+
+def make_source(imgs):
+    """Returns the model input for a batch: a preprocessed tensor if possible."""
+    if njit is None or any(img.shape != (AI_HEIGHT, AI_WIDTH, 3) for img in imgs):
+        return imgs
+    for i, img in enumerate(imgs):
+        preprocess_into(img, tensor_buf[i])
+    return torch.from_numpy(tensor_buf[:len(imgs)])
+
+# Live-only batches on the PyTorch CUDA path replay a CUDA graph of the raw
+# network instead of going through Ultralytics' per-call pipeline, and only
+# the final boxes of the whole batch are copied back, in one transfer.
+# TensorRT engines load as a path, not a module, so this path only runs when
+# the engine export is unavailable. The copy still waits on the GPU: NMS
+# indexes with data-dependent masks, which syncs anyway, so an async copy
+# overlapped with the next batch would need NMS inside the graph.
+class GraphedDetector:
+    """Per-batch-size CUDA graphs of the network, followed by NMS."""
+
+    def __init__(self, net):
+        self.eager = net
+        # Every graph has a fixed input shape, so let Inductor specialize
+        # the network for it too. The default mode has no CUDA graphs of
+        # its own (the whole call is captured here) and no autotuning, which
+        # keeps compiling all MAX_BATCH shapes short.
+        try:
+            self.net = torch.compile(net, dynamic=False)
+        except Exception as e:
+            print(f"[Warning] torch.compile unavailable ({e}), graphing the eager network")
+            self.net = net
+        # batch size -> (graph, static input, static output, kept tensors).
+        # Filled in by capture_all; sizes not in it yet use the predictor.
+        self.graphs = {}
+        self.pool = None
+
+    def warm_up(self, static_input):
+        # On a side stream so lazy init and compilation stay out of the graph
+        side = torch.cuda.Stream()
+        side.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side), torch.no_grad():
+            for _ in range(3):
+                self.net(static_input)
+        torch.cuda.current_stream().wait_stream(side)
+
+    def capture(self, n):
+        static_input = torch.zeros((n, 3, TENSOR_HEIGHT, AI_WIDTH), device="cuda", dtype=torch.half)
+        try:
+            self.warm_up(static_input)
+        except Exception as e:
+            if self.net is self.eager:
+                raise
+            print(f"[Warning] torch.compile failed ({e}), graphing the eager network")
+            self.net = self.eager
+            self.warm_up(static_input)
+
+        graph = torch.cuda.CUDAGraph()
+        # Thread-local: the inference thread keeps using the GPU meanwhile
+        with torch.no_grad(), torch.cuda.graph(graph, pool=self.pool,
+                                                capture_error_mode="thread_local"):
+            static_output = self.net(static_input)
+        self.pool = graph.pool()
+        # The Detect head rebuilds its anchors / strides whenever the input
+        # shape (batch size included) changes. This graph reads the current
+        # ones by address, so keep them alive past the next capture.
+        head = self.eager.model[-1]
+        kept = [v for v in vars(head).values() if isinstance(v, torch.Tensor)]
+        return graph, static_input, static_output, kept
+
+    def capture_all(self):
+        """Compiles and captures batch sizes 1 to MAX_BATCH, in order."""
+        print(f"[System] Capturing CUDA graphs for batch sizes 1-{MAX_BATCH}...")
+        for n in range(1, MAX_BATCH + 1):
+            try:
+                self.graphs[n] = self.capture(n)
+            except Exception as e:
+                print(f"[Warning] CUDA graph capture failed for batch {n} ({e}), "
+                      f"using the Ultralytics predictor for it")
+                return
+        print("[System] CUDA graphs ready")
+
+    def __call__(self, batch):
+        """Runs a (n, 3, TENSOR_HEIGHT, AI_WIDTH) CPU tensor. Returns boxes per image."""
+        n = len(batch)
+        graph, static_input, static_output, _ = self.graphs[n]
+        static_input.copy_(batch, non_blocking=True)
+        graph.replay()
+        dets = non_max_suppression(static_output, conf_thres=DETECT_CONF, iou_thres=DETECT_IOU,
+                                   classes=[0], max_det=MAX_DET)
+        boxes = torch.cat([d[:, :4] for d in dets]).cpu().numpy()
+        return np.split(boxes, np.cumsum([len(d) for d in dets])[:-1])
+
+graphed = None
+if njit is not None and predict_args and isinstance(model.model, torch.nn.Module):
+    try:
+        from ultralytics.utils.ops import non_max_suppression
+        import copy
+        graphed = GraphedDetector(copy.deepcopy(model.model).fuse().half().cuda().eval())
+    except Exception as e:
+        print(f"[Warning] CUDA graphs unavailable ({e}), using the Ultralytics predictor")
+        graphed = None
+    else:
+        # Compiling takes a while: do it off the import path so serving
+        # starts right away, on the predictor until each size is ready
+        threading.Thread(target=graphed.capture_all, daemon=True).start()
+
+def run_batch(imgs):
+    """Runs one model call. Returns an (N, 4) float xyxy array per image."""
+    global graphed
+    source = make_source(imgs)
+    if graphed is not None and isinstance(source, torch.Tensor) and len(source) in graphed.graphs:
+        try:
+            return graphed(source)
+        except Exception as e:
+            print(f"[Warning] CUDA graph replay failed ({e}), using the Ultralytics predictor")
+            graphed = None
+    results = model(source, conf=DETECT_CONF, iou=DETECT_IOU, classes=[0], max_det=MAX_DET,
+                    verbose=False, **predict_args)
+    return [r.boxes.xyxy.cpu().numpy() for r in results]
+
+def inference_loop():
+    while True:
+        items = [inference_queue.get()]
+        deadline = time.monotonic() + BATCH_WAIT
+        while len(items) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(inference_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            results = run_batch([img for img, _ in items])
+        except Exception as e:
+            if len(items) == 1:
+                items[0][1].set_exception(e)
+                continue
+            # Retry one at a time so only the failing image (e.g. a huge
+            # upload) gets the error, not the live frames batched with it
+            for img, future in items:
+                try:
+                    future.set_result(run_batch([img])[0])
+                except Exception as e:
+                    future.set_exception(e)
+            continue
+        for (_, future), det_boxes in zip(items, results):
+            future.set_result(det_boxes)
+
+def submit(img):
+    """Queues an image for batched inference. Returns a Future of its boxes."""
+    future = Future()
+    inference_queue.put((img, future))
+    return future
+
+def detect(img):
+    """Queues an image for batched inference and waits for its boxes."""
+    return submit(img).result()
+
+threading.Thread(target=inference_loop, daemon=True).start()
 
 # --- Shared State ---
+# Boxes are published as read-only (N, 4) int32 x1, y1, x2, y2 arrays and
+# swapped by reference, like frames
+NO_BOXES = np.empty((0, 4), np.int32)
+NO_BOXES.flags.writeable = False
+
 class VideoState:
     def __init__(self):
+        # Read-only view of the newest capture buffer. Swapped by reference,
+        # so readers take it without the lock and without copying.
         self.frame = None
-        self.boxes = []  
+        self.frame_id = 0 # Bumped after each new state.frame
+        # Latest (frame_id, frame) handoff to ai_loop; capture replaces any
+        # unconsumed frame
+        self.frame_q = queue.Queue(maxsize=1)
+        self.boxes = NO_BOXES
+        self.boxes_version = 0 # Bumped whenever ai_loop publishes boxes
+        # Reused AI inputs, saves an allocation per frame. Only ai_loop writes
+        # them, alternating, and never into one whose inference is pending.
+        self.ai_bufs = [np.empty((AI_HEIGHT, AI_WIDTH, 3), np.uint8) for _ in range(2)]
         self.count = 0
+        # One Queue(maxsize=1) per /video_feed viewer, fed by encoder_loop
+        self.subscribers = set()
+        self.last_jpeg = None # Latest annotated frame, sent first to new viewers
         self.lock = threading.Lock()
+        # Bumped and notified only when count changes (or the stream stops)
+        self.count_version = 0
+        self.count_changed = threading.Condition(self.lock)
         self.running = False 
 
 state = VideoState()
 
 # --- Thread Functions ---
-def capture_loop():
-    print(f"[Thread 1] Connecting to Stream: {RTSP_URL}...")
+def publish_frame(frame):
+    published = frame.view()
+    published.setflags(write=False)
+    state.frame = published
+    state.frame_id += 1
+    # Only the capture thread puts, so after dropping a stale frame there's room
+    try:
+        state.frame_q.get_nowait()
+    except queue.Empty:
+        pass
+    state.frame_q.put_nowait((state.frame_id, published))
+
+def frame_is_intact(frame_id):
+    """
+    True if the ring slot holding frame frame_id can't have been reused yet:
+    the capture thread only decodes into it again after publishing
+    FRAME_BUFFERS - 1 newer frames.
+    """
+    return state.frame_id - frame_id < FRAME_BUFFERS - 1
+
+def capture_nvdec():
+    """
+    Decodes the stream on the GPU (FFmpeg NVDEC through PyAV), freeing the
+    CPU core OpenCV's software H.264 decode takes. Returns False if there is
+    no CUDA device, no NVDEC decoder for the stream in PyAV's FFmpeg build,
+    or the decoder fails before producing its first frame.
+    """
+    # predict_args is only set when CUDA is available
+    if av is None or not predict_args:
+        return False
+
+    verified = False # NVDEC has decoded a frame on this machine
+    while state.running:
+        try:
+            container = av.open(RTSP_URL, options={"rtsp_transport": "tcp"}, timeout=5)
+        except Exception as e:
+            print(f"Stream unavailable ({e}). Reconnecting in 2s...")
+            time.sleep(2)
+            continue
+
+        try:
+            stream = container.streams.video[0]
+            try:
+                decoder = av.CodecContext.create(f"{stream.codec_context.name}_cuvid", "r")
+                decoder.extradata = stream.codec_context.extradata
+                decoder.open()
+            except Exception as e:
+                print(f"[Warning] NVDEC decoder not available ({e}), using OpenCV decode")
+                return False
+
+            for i, packet in enumerate(container.demux(stream)):
+                if not state.running:
+                    break
+                try:
+                    frames = decoder.decode(packet)
+                except Exception as e:
+                    if verified:
+                        raise
+                    # Missing device, unsupported profile, driver mismatch...
+                    print(f"[Warning] NVDEC decode failed ({e}), using OpenCV decode")
+                    return False
+                if not verified and not frames and i >= 100:
+                    print("[Warning] NVDEC produced no frames, using OpenCV decode")
+                    return False
+                for frame in frames:
+                    verified = True
+                    # to_ndarray returns a new array per frame, no ring needed
+                    publish_frame(frame.to_ndarray(format="bgr24"))
+        except Exception as e:
+            print(f"Stream error: {e}")
+        finally:
+            container.close()
+
+        if state.running:
+            print("Stream interrupted. Reconnecting in 2s...")
+            time.sleep(2)
+    return True
+
+def capture_opencv():
     os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp"
 
     cap = cv2.VideoCapture(RTSP_URL)
     cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
+    buffers = []
+    slot = 0
     while state.running:
-        ret, frame = cap.read()
+        ret = cap.grab()
+        if ret:
+            # Decode straight into the next ring slot, never the published one
+            ret, frame = cap.retrieve(buffers[slot] if buffers else None)
         if not ret:
             print("Stream interrupted. Reconnecting in 2s...")
             cap.release()
@@ -53,54 +444,159 @@ def capture_loop():
             cap = cv2.VideoCapture(RTSP_URL)
             cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
             continue
-        
-        with state.lock:
-            state.frame = frame
+
+        if not buffers or not np.may_share_memory(frame, buffers[slot]):
+            # First frame or a resolution change: (re)allocate the ring
+            buffers = [frame] + [np.empty_like(frame) for _ in range(FRAME_BUFFERS - 1)]
+            slot = 0
+
+        publish_frame(frame)
+        slot = (slot + 1) % FRAME_BUFFERS
     
     cap.release()
+
+def capture_loop():
+    print(f"[Thread 1] Connecting to Stream: {RTSP_URL}...")
+    if not capture_nvdec():
+        capture_opencv()
     print("[Thread 1] Stopped.")
 
+def publish_detections(future, orig_w, orig_h):
+    det_boxes = future.result()
+
+    current_boxes = NO_BOXES
+    if len(det_boxes):
+        x_scale = orig_w / AI_WIDTH
+        y_scale = orig_h / AI_HEIGHT
+        scale = np.array([x_scale, y_scale, x_scale, y_scale], dtype=np.float32)
+        current_boxes = (det_boxes * scale).astype(np.int32)
+        current_boxes.flags.writeable = False
+
+    with state.count_changed:
+        state.boxes = current_boxes
+        state.boxes_version += 1
+        if len(current_boxes) != state.count:
+            state.count = len(current_boxes)
+            state.count_version += 1
+            state.count_changed.notify_all()
+
 def ai_loop():
     print("[Thread 2] AI Processing Started...")
-    ai_width = 640
-    ai_height = 360
+    # Two-stage pipeline: the next frame is resized and queued while the
+    # previous one is still on the GPU
+    in_flight = None # (future, orig_w, orig_h)
+    buf_idx = 0
 
     while state.running:
-        working_frame = None
-        with state.lock:
-            if state.frame is not None:
-                working_frame = state.frame.copy()
-
-        if working_frame is None:
-            time.sleep(0.05)
+        # Blocks until a new frame arrives, so the same frame is never
+        # inferred twice. No copy: it is only read by the resize below.
+        try:
+            frame_id, working_frame = state.frame_q.get(timeout=0.1)
+        except queue.Empty:
             continue
 
         orig_h, orig_w = working_frame.shape[:2]
-        input_frame = cv2.resize(working_frame, (ai_width, ai_height))
-        
-        with model_lock:
-            results = model(input_frame, conf=0.5, classes=[0], verbose=False)
+        if USE_OPENCL:
+            input_frame = cv2.resize(cv2.UMat(working_frame), (AI_WIDTH, AI_HEIGHT),
+                                     interpolation=cv2.INTER_LINEAR).get()
+        else:
+            input_frame = cv2.resize(working_frame, (AI_WIDTH, AI_HEIGHT), dst=state.ai_bufs[buf_idx],
+                                     interpolation=cv2.INTER_LINEAR)
+        if not frame_is_intact(frame_id):
+            continue # Source overwritten mid-resize: skip this frame
+        future = submit(input_frame)
+        buf_idx ^= 1
         
-        current_boxes = []
-        if len(results) > 0:
-            det_boxes = results[0].boxes.xyxy.cpu().numpy()
-            x_scale = orig_w / ai_width
-            y_scale = orig_h / ai_height
-
-            for box in det_boxes:
-                x1, y1, x2, y2 = box
-                x1 = int(x1 * x_scale)
-                y1 = int(y1 * y_scale)
-                x2 = int(x2 * x_scale)
-                y2 = int(y2 * y_scale)
-                current_boxes.append((x1, y1, x2, y2))
+        if in_flight is not None:
+            try:
+                publish_detections(*in_flight)
+            except Exception as e:
+                # One failed frame keeps the last boxes; the loop goes on
+                print(f"[Warning] Inference failed: {e}")
+        in_flight = (future, orig_w, orig_h)
+    print("[Thread 2] Stopped.")
 
+def wait_next_frame(next_t):
+    """
+    Sleeps until one frame interval after next_t, so encode time is part of
+    the interval rather than added to it. Returns the new deadline.
+    """
+    next_t += FRAME_INTERVAL
+    delay = next_t - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    elif delay < -FRAME_INTERVAL:
+        # More than a frame behind: restart the clock instead of bursting
+        next_t = time.monotonic()
+    return next_t
+
+def encoder_loop():
+    # Draws and encodes each frame once, then fans the bytes out to every
+    # viewer, so the CPU cost doesn't grow with the number of open tabs
+    print("[Thread 3] Encoder Started...")
+    last_key = None
+    next_t = time.monotonic()
+
+    while state.running:
+        # Id before frame: a frame newer than its id only costs a re-encode,
+        # and makes the intact check below err on the safe side
+        frame_id = state.frame_id
+        frame = state.frame
         with state.lock:
-            state.count = len(current_boxes)
-            state.boxes = current_boxes
-            
-        time.sleep(0.01) 
-    print("[Thread 2] Stopped.")
+            subscribers = list(state.subscribers)
+            # Replaced wholesale by ai_loop, read-only: no copy needed
+            current_boxes = state.boxes
+            key = (frame_id, state.boxes_version)
+
+        if frame is None or not subscribers:
+            time.sleep(0.1)
+            continue
+
+        if key == last_key:
+            # Same frame, same boxes: viewers already have these bytes
+            next_t = wait_next_frame(next_t)
+            continue
+
+        if len(current_boxes) == 0:
+            # Nothing to draw: the encoder only reads, so the shared frame
+            # is encoded as is
+            output_frame = frame
+        else:
+            # The shared frame is read-only; drawing needs a private copy
+            # (uploading it to a UMat makes one on the OpenCL path)
+            output_frame = cv2.UMat(frame) if USE_OPENCL else frame.copy()
+
+            # Draw Cyberpunk Style Boxes
+            # One C-level conversion of the whole array to ints for cv2
+            for (x1, y1, x2, y2) in current_boxes.tolist():
+                # Corners only for cleaner look? Or full box. Let's do full box thin.
+                cv2.rectangle(output_frame, (x1, y1), (x2, y2), (0, 255, 255), 2)
+                # Label
+                label = "TARGET"
+                cv2.putText(output_frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+
+            if USE_OPENCL:
+                output_frame = output_frame.get()
+        jpeg_bytes = encode_jpeg(output_frame)
+        if not frame_is_intact(frame_id):
+            # The capture thread may have decoded into the frame while it was
+            # copied or encoded: don't send a torn image
+            jpeg_bytes = None
+        if jpeg_bytes is not None:
+            last_key = key
+            state.last_jpeg = jpeg_bytes
+            for q in subscribers:
+                # A slow viewer skips to the newest frame instead of queueing
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(jpeg_bytes)
+                except queue.Full:
+                    pass
+        next_t = wait_next_frame(next_t)
+    print("[Thread 3] Stopped.")
 
 # --- Flask Routes ---
 
@@ -108,8 +604,10 @@ def ai_loop():
 def start_stream():
     if not state.running:
         state.running = True
+        state.frame_q = queue.Queue(maxsize=1) # Drop any frame from the last run
         threading.Thread(target=capture_loop, daemon=True).start()
         threading.Thread(target=ai_loop, daemon=True).start()
+        threading.Thread(target=encoder_loop, daemon=True).start()
         return jsonify({"status": "started"})
     return jsonify({"status": "already_running"})
 
@@ -118,10 +616,14 @@ def stop_stream():
     if state.running:
         state.running = False 
         time.sleep(0.5)
-        with state.lock:
+        with state.count_changed:
             state.frame = None
+            state.last_jpeg = None
             state.count = 0
-            state.boxes = []
+            state.boxes = NO_BOXES
+            # Wake the SSE clients so they see the stop right away
+            state.count_version += 1
+            state.count_changed.notify_all()
         return jsonify({"status": "stopped"})
     return jsonify({"status": "not_running"})
 
@@ -132,11 +634,10 @@ def upload_photo():
     file = request.files['file']
     
     try:
-        file_bytes = np.frombuffer(file.read(), np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        with model_lock:
-            results = model(img, conf=0.5, classes=[0], verbose=False)
-        count = len(results[0].boxes)
+        img = decode_image(file.read())
+        if img is None:
+            return jsonify({"error": "Unsupported image"}), 400
+        count = len(detect(img))
         return jsonify({"message": "Success", "detected_count": count})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -144,56 +645,53 @@ def upload_photo():
 @app.route('/video_feed')
 def video_feed():
     def generate_annotated_feed():
-        while True:
-            if not state.running:
-                break 
-            
-            output_frame = None
-            current_boxes = []
+        q = queue.Queue(maxsize=1)
+        with state.lock:
+            state.subscribers.add(q)
+            cached = state.last_jpeg
+        try:
+            # The encoder only sends on change, so start from the cached frame
+            if cached is not None:
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + cached + b'\r\n')
+            while True:
+                if not state.running:
+                    break 
 
-            with state.lock:
-                if state.frame is None:
-                    time.sleep(0.1)
+                try:
+                    jpeg_bytes = q.get(timeout=1.0)
+                except queue.Empty:
                     continue
-                output_frame = state.frame.copy()
-                current_boxes = list(state.boxes)
-
-            # Draw Cyberpunk Style Boxes
-            for (x1, y1, x2, y2) in current_boxes:
-                # Corners only for cleaner look? Or full box. Let's do full box thin.
-                cv2.rectangle(output_frame, (x1, y1), (x2, y2), (0, 255, 255), 2)
-                # Label
-                label = "TARGET"
-                cv2.putText(output_frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
-
-            ret, buffer = cv2.imencode('.jpg', output_frame)
-            if ret:
                 yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-            time.sleep(0.033)
+                       b'Content-Type: image/jpeg\r\n\r\n' + jpeg_bytes + b'\r\n')
+        finally:
+            # Also runs on GeneratorExit when the client disconnects
+            with state.lock:
+                state.subscribers.discard(q)
             
     return Response(generate_annotated_feed(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/count_feed')
 def count_feed():
     def generate_sse_count():
-        last_count = -1
+        last_version = -1
         while True:
             if not state.running:
                 yield f"data: 0\n\n"
                 break
-            with state.lock:
+            with state.count_changed:
+                state.count_changed.wait_for(lambda: state.count_version != last_version,
+                                             timeout=30)
                 c = state.count
-            if c != last_count:
+                version = state.count_version
+            if version != last_version:
                 yield f"data: {c}\n\n"
-                last_count = c
-            time.sleep(0.5)
+                last_version = version
     return Response(generate_sse_count(), mimetype='text/event-stream')
 
 # --- Frontend Template ---
-@app.route('/')
-def index():
-    return render_template_string("""
+# The page has no template variables: build it once, gzipped up front
+INDEX_HTML = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -556,7 +1054,18 @@ def index():
   </script>
 </body>
 </html>
-    """)
+    """.encode()
+INDEX_HTML_GZ = gzip.compress(INDEX_HTML, 9)
+
+@app.route('/')
+def index():
+    if request.accept_encodings['gzip']:
+        resp = Response(INDEX_HTML_GZ, mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = Response(INDEX_HTML, mimetype='text/html')
+    resp.vary.add('Accept-Encoding')
+    return resp
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file